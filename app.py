@@ -1,27 +1,75 @@
+from gevent import monkey
+monkey.patch_all()
+
 from flask import (
-    Flask, render_template, request, redirect, url_for, session, jsonify, flash
+    Flask, render_template, request, redirect, url_for, session, flash,
+    Response, stream_with_context, stream_template, get_flashed_messages
 )
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token
+from flask.json.provider import JSONProvider
+from jinja2 import FileSystemBytecodeCache
+from flask_session import Session
 import os
 import requests 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import timedelta
-import openai 
+import orjson
+import redis
 from dotenv import load_dotenv 
 import traceback 
+import hashlib
+import secrets
+import logging
+import re
 
 
 load_dotenv()
 
+# Modules that log (e.g. database.py) stay quiet below WARNING in production;
+# set LOG_LEVEL=DEBUG to see every query outcome.
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING').upper(), format='%(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
 from meal_suggestion import CreateMeal
 from recipe_creation import CreateRecipe
 from database import Database
-from utils import format_recipe_for_display 
+from utils import format_recipe_for_display, parse_csv, load_zip_centroids, normalize_meal_idea
+from cache import redis_client, cached, local_cached, invalidate, cache_get, cache_set
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, which encodes and decodes much faster than the stdlib."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# --- Templates ---
+# Compiled templates are written to a bytecode cache in the temp directory so a restarted
+# worker loads them instead of re-parsing the sources. Outside debug mode, templates are
+# never checked for changes on render.
+
+app.config['TEMPLATES_AUTO_RELOAD'] = os.getenv('FLASK_DEBUG') == '1'
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 # --- Secret Keys & JWT Configuration ---
 
-app.secret_key = os.getenv('FLASK_SECRET_KEY', os.urandom(24))
+# A random fallback key differs per gunicorn worker, so sessions signed by one worker
+# are rejected by the others. Only allow it for local development.
+secret_key = os.getenv('FLASK_SECRET_KEY')
+if not secret_key:
+    if os.getenv('FLASK_DEBUG') != '1':
+        raise RuntimeError("FLASK_SECRET_KEY is not set. Please set it in your .env file.")
+    logger.warning("FLASK_SECRET_KEY is not set; using a random key for this process.")
+    secret_key = os.urandom(24)
+app.secret_key = secret_key
 
 
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'a-very-strong-default-jwt-secret-for-dev')
@@ -29,22 +77,356 @@ app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
 
 jwt = JWTManager(app)
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# --- Server-side Sessions ---
+# Recipe data can be several KB of JSON, so keep it in Redis and only send the
+# session id to the browser instead of signing the whole payload into a cookie.
+
+app.config['SESSION_TYPE'] = 'redis'
+app.config['SESSION_REDIS'] = redis_client
+app.config['SESSION_USE_SIGNER'] = True
+app.config['SESSION_PERMANENT'] = True
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)
+
+Session(app)
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") 
 
+# One keep-alive session for all Google Maps calls so Places searches reuse
+# TCP/TLS connections instead of handshaking on every call.
+# Transient 429/5xx responses are retried with a short backoff.
+GOOGLE_HTTP = requests.Session()
+GOOGLE_HTTP.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+))
+GOOGLE_TIMEOUT = (3, 5)  # (connect, read) seconds
+NEARBY_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+TEXT_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json"
+
+# US ZIP code -> "lat,lng" centroids, so most grocery lookups can use a plain Nearby Search
+ZIP_CENTROIDS = load_zip_centroids(os.getenv('ZIP_CENTROIDS_PATH', '2020_Gaz_zcta_national.txt'))
+# 5-digit ZIP or ZIP+4 in ASCII digits (\d would also accept e.g. Arabic-Indic ones);
+# anything else is rejected before it costs a Places call
+ZIP_RE = re.compile(r'([0-9]{5})(?:-[0-9]{4})?')
+
 db = Database()
-db.create_tables() 
 meal_suggestion_service = CreateMeal()
-recipe_creation_service = CreateRecipe()
+recipe_creation_service = CreateRecipe(meal_suggestion=meal_suggestion_service)
+
+# --- Cached Lookups ---
+# History is invalidated on save/delete; user rows only change on registration,
+# and unknown usernames are never cached, so a new account is found right away.
+# Repeat logins for the same user are answered from process memory for 30s.
+
+get_user_by_username = local_cached(maxsize=1024, ttl=30)(
+    cached('user:{0}', ttl=300)(db.get_user_by_username)
+)
+
+
+HISTORY_PAGE_SIZE = 20
+# Far past any real history, and keeps the OFFSET well inside SQLite's 64-bit integers
+MAX_HISTORY_PAGE = 10000
+
+
+def meal_history(user_id, page=1):
+    """
+    One page of a user's saved meals, plus whether there is an older page after it.
+    Only the first page, which is what almost every visit shows, is cached, so saving or
+    deleting a meal still invalidates the user's history with a single key.
+    """
+    offset = (page - 1) * HISTORY_PAGE_SIZE
+    # One extra row tells us whether another page follows
+    if page == 1:
+        history = _first_history_page(user_id)
+    else:
+        history = list(db.meal_history(user_id, HISTORY_PAGE_SIZE + 1, offset))
+    return history[:HISTORY_PAGE_SIZE], len(history) > HISTORY_PAGE_SIZE
+
+
+@cached('history:{0}', ttl=60)
+def _first_history_page(user_id):
+    return list(db.meal_history(user_id, HISTORY_PAGE_SIZE + 1))
+
+
+def inputs_key(user_inputs, *extra):
+    """
+    A short hash of the user's inputs (plus any extra strings, like a meal idea), normalized
+    so that tool or restriction order and letter case don't change the key.
+    """
+    return hashlib.blake2b(orjson.dumps([
+        *(str(part or '').strip().lower() for part in extra),
+        user_inputs['type_of_meal'], user_inputs['budget'], user_inputs['time'],
+        sorted(t.lower() for t in user_inputs['tools']),
+        sorted(r.lower() for r in user_inputs['dietary_restrictions'])
+    ]), digest_size=16).hexdigest()
+
+
+MEAL_TTL = 600
+RECIPE_TTL = 86400
+
+
+def meal_cache_key(user_inputs, base_idea=None, variation_prompt=None):
+    """The Redis key meal_and_recipe caches a meal idea and its recipe text under."""
+    return f"meal:{inputs_key(user_inputs, user_inputs['mood'], base_idea, variation_prompt)}"
+
+
+def recipe_cache_key(meal_idea, user_inputs):
+    """The Redis key recipe_details caches a meal's recipe under."""
+    return f"recipe:{inputs_key(user_inputs, normalize_meal_idea(meal_idea))}"
+
+
+def meal_and_recipe(user_inputs, base_idea=None, variation_prompt=None):
+    """
+    create_meal_and_recipe behind a short-lived Redis cache keyed by the normalized inputs, so
+    identical requests arriving close together (e.g. a double-submitted form) share one
+    OpenAI call. The TTL is kept short so repeat visitors still get fresh ideas.
+    Returns (meal_idea, recipe_text), both None on failure.
+    """
+    result = _meal_and_recipe(meal_cache_key(user_inputs, base_idea, variation_prompt), user_inputs, base_idea, variation_prompt)
+    return tuple(result) if result else (None, None)
+
+
+@cached('{0}', ttl=MEAL_TTL)
+def _meal_and_recipe(key, user_inputs, base_idea, variation_prompt):
+    meal_idea, recipe_text = meal_suggestion_service.create_meal_and_recipe(
+        user_inputs['budget'], user_inputs['mood'], user_inputs['type_of_meal'], user_inputs['tools'],
+        user_inputs['time'], user_inputs['dietary_restrictions'],
+        base_idea=base_idea, variation_prompt=variation_prompt
+    )
+    # A failed call returns None so cached() doesn't store it
+    return [meal_idea, recipe_text] if meal_idea else None
+
+
+def recipe_details(meal_idea, user_inputs, genai_recipe_text=None):
+    """
+    req_recipe_details behind a Redis cache keyed by the meal idea and the user's inputs, so
+    the same request from any user reuses the earlier Tasty match or generated recipe.
+    Ideas that only differ in wording (see normalize_meal_idea) share an entry.
+    """
+    return _recipe_details(recipe_cache_key(meal_idea, user_inputs), meal_idea, user_inputs, genai_recipe_text)
+
+
+@cached('{0}', ttl=RECIPE_TTL)
+def _recipe_details(key, meal_idea, user_inputs, genai_recipe_text):
+    return recipe_creation_service.req_recipe_details(
+        meal_idea, user_inputs['type_of_meal'], user_inputs['budget'], user_inputs['tools'],
+        user_inputs['time'], user_inputs['dietary_restrictions'],
+        genai_recipe_text=genai_recipe_text
+    )
+
+# --- Variation Prefetching ---
+# Saved recipes are queued and `flask prefetch-variations` (run on a schedule) generates these
+# variations through the cheaper OpenAI Batch API, so picking one later skips the live LLM call.
+
+PREFETCH_VARIATIONS = ('spicier', 'vegetarian version', 'cheaper')
+VARIATION_TTL = 86400 * 7
+
+app.jinja_env.globals['suggested_variations'] = PREFETCH_VARIATIONS
+
+
+def variation_key(user_id, base_idea):
+    return f"variations:{user_id}:{base_idea.strip().lower()}"
+
+
+def queue_variation_prefetch(user_id, meal_idea, user_inputs):
+    """Queues a saved recipe for background variation generation."""
+    try:
+        redis_client.rpush('variation_queue', orjson.dumps({
+            'user_id': user_id, 'meal_idea': meal_idea, 'user_inputs': user_inputs
+        }))
+    except redis.RedisError as e:
+        logger.warning("Could not queue variation prefetch for '%s': %s", meal_idea, e)
+
+
+def get_prefetched_variation(user_id, base_idea, variation_prompt):
+    """Returns a batch-generated variation idea for this prompt, or None if there isn't one."""
+    try:
+        idea = redis_client.hget(variation_key(user_id, base_idea), variation_prompt.strip().lower())
+        return idea.decode() if idea else None
+    except redis.RedisError as e:
+        logger.warning("Could not read prefetched variations for '%s': %s", base_idea, e)
+        return None
+
+
+# --- Request & Session Helpers ---
+
+RECIPE_KEYS = ('current_meal_idea', 'user_inputs', 'current_recipe_data', 'current_formatted_recipe')
+
+
+def recipe_inputs_from(values):
+    """Builds the user_inputs dict from the create-recipe form fields (request.form or request.args)."""
+    get = values.get
+    return {
+        'type_of_meal': get('type_of_meal', ''),
+        'budget': get('budget', ''),
+        'mood': get('mood', ''),
+        'tools': parse_csv(get('tools', '')),
+        'time': get('time', ''),
+        'dietary_restrictions': parse_csv(get('dietary_restrictions', ''))
+    }
+
+
+def sse_event(event, data):
+    """Encodes one Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+def set_current_recipe(recipe_data):
+    """
+    Stores the in-progress recipe along with its formatted display parts, so later requests
+    (grocery lookups, error pages, the variation fallback) don't format it again.
+    Returns the formatted recipe.
+    """
+    formatted_recipe = format_recipe_for_display(recipe_data)
+    session['current_recipe_data'] = recipe_data
+    session['current_formatted_recipe'] = formatted_recipe
+    return formatted_recipe
+
+
+def current_formatted_recipe():
+    """The formatted in-progress recipe, formatted on the spot only if the session doesn't have it stored."""
+    formatted_recipe = session.get('current_formatted_recipe')
+    if formatted_recipe is None:
+        formatted_recipe = format_recipe_for_display(session.get('current_recipe_data'))
+    return formatted_recipe
+
+
+def render_recipe_details(**overrides):
+    """
+    Renders recipe_details.html for the in-progress recipe in the session, offering the save
+    options. Keyword arguments add to or replace those defaults (e.g. stores, zipcode).
+    """
+    context = {
+        'meal_idea': session.get('current_meal_idea'),
+        'user_inputs': session.get('user_inputs'),
+        'show_save_options': True
+    }
+    context.update(overrides)
+    if 'recipe' not in context:
+        context['recipe'] = current_formatted_recipe()
+    return render_template('recipe_details.html', **context)
+
+
+STREAM_RESULT_TTL = 600
+
+
+def take_stream_result(result_id):
+    """
+    Moves a recipe finished by /create_recipe_stream into the session, if it belongs to the
+    logged-in user. Each result can only be taken once.
+    """
+    key = f"stream_result:{result_id}"
+    result = cache_get(key)
+    if not result or result['user_id'] != session['user_id']:
+        return
+    invalidate(key)
+    session['user_inputs'] = result['user_inputs']
+    session['current_meal_idea'] = result['meal_idea']
+    set_current_recipe(result['recipe_data'])
+
+
+def clear_recipe_state():
+    """Drops the in-progress recipe from the session, touching it only if something is stored."""
+    for key in RECIPE_KEYS:
+        if key in session:
+            session.pop(key)
+
+
+# --- CLI ---
+
+@app.cli.command('init-db')
+def init_db():
+    """Creates the database tables. Run once per deploy, before starting the server."""
+    db.create_tables()
+    print("Database tables are ready.")
+
+
+@app.cli.command('prefetch-variations')
+def prefetch_variations():
+    """
+    Stores finished variation batches in Redis, then submits one new batch covering every
+    recipe saved since the last run. Meant to run on a schedule, e.g. a nightly cron job.
+    """
+    for batch_id in redis_client.smembers('variation_batches'):
+        batch_id = batch_id.decode()
+        results = meal_suggestion_service.collect_variation_batch(batch_id)
+        if results is None:
+            continue
+
+        targets = redis_client.hgetall(f"variation_batch:{batch_id}")
+        for custom_id, meal_idea in results.items():
+            target = targets.get(custom_id.encode())
+            if target:
+                user_id, base_idea, variation_prompt = orjson.loads(target)
+                key = variation_key(user_id, base_idea)
+                redis_client.hset(key, variation_prompt, meal_idea)
+                redis_client.expire(key, VARIATION_TTL)
+        redis_client.srem('variation_batches', batch_id)
+        redis_client.delete(f"variation_batch:{batch_id}")
+        print(f"Stored {len(results)} variations from batch {batch_id}.")
+
+    queued, jobs, targets = [], {}, {}
+    while (entry := redis_client.lpop('variation_queue')) is not None:
+        queued.append(entry)
+        saved = orjson.loads(entry)
+        user_inputs = saved['user_inputs']
+        for variation_prompt in PREFETCH_VARIATIONS:
+            custom_id = str(len(jobs))
+            jobs[custom_id] = {
+                'budget': user_inputs['budget'],
+                'mood': user_inputs['mood'],
+                'type_of_meal': user_inputs['type_of_meal'],
+                'tools': user_inputs['tools'],
+                'time': user_inputs['time'],
+                'dietary_restrictions': user_inputs['dietary_restrictions'],
+                'base_idea': saved['meal_idea'],
+                'variation_prompt': variation_prompt
+            }
+            targets[custom_id] = orjson.dumps([saved['user_id'], saved['meal_idea'], variation_prompt])
+
+    if not jobs:
+        print("No saved recipes waiting for variations.")
+        return
+
+    batch_id = meal_suggestion_service.submit_variation_batch(jobs)
+    if not batch_id:
+        # Put the recipes back so the next run retries them
+        redis_client.rpush('variation_queue', *queued)
+        return
+
+    redis_client.hset(f"variation_batch:{batch_id}", mapping=targets)
+    redis_client.sadd('variation_batches', batch_id)
+    print(f"Submitted batch {batch_id} with {len(jobs)} variation requests.")
+
 
 # --- Routes ---
 
+# Pages that look the same for every logged-out visitor
+CONDITIONAL_ENDPOINTS = {'index', 'about'}
+
+
+@app.after_request
+def add_cache_headers(response):
+    """
+    Tags the logged-out home and about pages with an ETag so a reload gets a bodyless 304
+    when nothing changed. They are still revalidated on every request, because the same URL
+    renders differently once the visitor logs in or has a flash message waiting.
+    """
+    if (request.method == 'GET' and request.endpoint in CONDITIONAL_ENDPOINTS
+            and response.status_code == 200 and 'user_id' not in session):
+        response.add_etag()
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return response
+
+
 @app.route('/')
 def index():
 
-    session.pop('current_meal_idea', None)
-    session.pop('user_inputs', None)
-    session.pop('current_recipe_data', None)
+    clear_recipe_state()
 
   
     user_logged_in = 'user_id' in session
@@ -91,9 +473,9 @@ def login():
             flash('Username and password are required.', 'error')
             return render_template('login.html')
 
-        user = db.get_user_by_username(username)
+        user = get_user_by_username(username)
         if user and db.verify_password(user, password):
-            access_token = create_access_token(identity=user['id'])
+            access_token = create_access_token(identity=str(user['id']))
             session['access_token'] = access_token
             session['user_id'] = user['id'] 
             session['username'] = user['username'] 
@@ -119,27 +501,11 @@ def create_recipe_page():
         return redirect(url_for('login'))
 
     if request.method == 'POST':
-        type_of_meal = request.form['type_of_meal']
-        budget = request.form['budget']
-        mood = request.form['mood']
-        tools = [t.strip() for t in request.form['tools'].split(',') if t.strip()]
-        time = request.form['time']
-
-        dietary_restrictions = [t.strip() for t in request.form['dietary_restrictions'].split(',') if t.strip()]
-
-        user_inputs = {
-            'type_of_meal': type_of_meal,
-            'budget': budget,
-            'mood': mood,
-            'tools': tools,
-            'time': time,
-            'dietary_restrictions': dietary_restrictions
-        }
+        user_inputs = recipe_inputs_from(request.form)
         session['user_inputs'] = user_inputs
 
-        meal_idea = meal_suggestion_service.create_meal(
-            budget, mood, type_of_meal, tools, time, dietary_restrictions
-        )
+        # One LLM call returns the idea and a ready-made recipe to fall back on if Tasty has no match
+        meal_idea, genai_recipe_text = meal_and_recipe(user_inputs)
 
         if not meal_idea:
             flash("Sorry, couldn't come up with a meal idea. Please try again with different preferences.", 'error')
@@ -147,27 +513,107 @@ def create_recipe_page():
 
         session['current_meal_idea'] = meal_idea
 
-        recipe_data = recipe_creation_service.req_recipe_details(
-            meal_idea, type_of_meal, budget, tools, time, dietary_restrictions
-        )
+        recipe_data = recipe_details(meal_idea, user_inputs, genai_recipe_text)
 
         if not recipe_data:
             flash("Couldn't find or generate a suitable recipe. Please try a different meal idea or adjust your preferences.", 'error')
             return render_template('create_recipe.html', user_inputs=user_inputs)
 
-        session['current_recipe_data'] = recipe_data
-
-        formatted_recipe = format_recipe_for_display(recipe_data)
-        return render_template('recipe_details.html',
-                               meal_idea=meal_idea,
-                               recipe=formatted_recipe,
-                               user_inputs=user_inputs,
-                               show_save_options=True) 
+        set_current_recipe(recipe_data)
+        return render_recipe_details()
 
    
     return render_template('create_recipe.html', user_inputs=session.get('user_inputs', {}))
 
 
+@app.route('/create_recipe_stream')
+def create_recipe_stream():
+    """
+    Server-Sent Events version of the create_recipe_page POST, used by browsers with EventSource.
+    Sends the meal idea as soon as it exists, then the recipe text as OpenAI writes it, and
+    finally a 'done' event pointing at the finished recipe page.
+    """
+    if 'user_id' not in session:
+        return Response(sse_event('failed', {'message': 'Please login to create recipes.'}),
+                        mimetype='text/event-stream')
+
+    user_inputs = recipe_inputs_from(request.args)
+    user_id = session['user_id']
+
+    def generate():
+        # Same caches as the create_recipe_page POST: a hit skips OpenAI and arrives in one event
+        meal_key = meal_cache_key(user_inputs)
+        cached_meal = cache_get(meal_key)
+        if cached_meal:
+            meal_idea, genai_recipe_text = cached_meal
+        else:
+            genai_recipe_text = None
+            meal_idea = meal_suggestion_service.create_meal(
+                user_inputs['budget'], user_inputs['mood'], user_inputs['type_of_meal'], user_inputs['tools'],
+                user_inputs['time'], user_inputs['dietary_restrictions']
+            )
+        if not meal_idea:
+            yield sse_event('failed', {'message': "Sorry, couldn't come up with a meal idea. Please try again with different preferences."})
+            return
+
+        yield sse_event('meal_idea', {'meal_idea': meal_idea})
+
+        recipe_key = recipe_cache_key(meal_idea, user_inputs)
+        recipe_data = cache_get(recipe_key)
+        if not recipe_data and genai_recipe_text:
+            # The cached idea came with its recipe text, so there is nothing left to stream
+            recipe_data = recipe_details(meal_idea, user_inputs, genai_recipe_text)
+        if not recipe_data:
+            for kind, payload in recipe_creation_service.stream_recipe_details(
+                meal_idea, user_inputs['type_of_meal'], user_inputs['budget'], user_inputs['tools'],
+                user_inputs['time'], user_inputs['dietary_restrictions']
+            ):
+                if kind == 'chunk':
+                    yield sse_event('chunk', {'text': payload})
+                else:
+                    recipe_data = payload
+            if recipe_data:
+                cache_set(recipe_key, recipe_data, RECIPE_TTL)
+
+        if not recipe_data:
+            yield sse_event('failed', {'message': "Couldn't find or generate a suitable recipe. Please try a different meal idea or adjust your preferences."})
+            return
+
+        if not cached_meal:
+            # The recipe is cached under its own key, so the POST route only needs the idea
+            cache_set(meal_key, [meal_idea, None], MEAL_TTL)
+
+        # The session went out with the response headers, so /current_recipe picks the result
+        # up from Redis and stores it in the session as part of its own response.
+        result_id = secrets.token_urlsafe(16)
+        cache_set(f"stream_result:{result_id}", {
+            'user_id': user_id, 'user_inputs': user_inputs, 'meal_idea': meal_idea, 'recipe_data': recipe_data
+        }, STREAM_RESULT_TTL)
+
+        yield sse_event('done', {'url': url_for('current_recipe', result=result_id)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/current_recipe')
+def current_recipe():
+    if 'user_id' not in session:
+        flash('Please login to view recipes.', 'warning')
+        return redirect(url_for('login'))
+
+    result_id = request.args.get('result')
+    if result_id:
+        take_stream_result(result_id)
+
+    recipe_data = session.get('current_recipe_data')
+    if not recipe_data:
+        flash("No recipe in progress. Please start a new recipe.", 'error')
+        return redirect(url_for('create_recipe_page'))
+
+    return render_recipe_details()
+
+
 @app.route('/variation', methods=['POST'])
 def variation():
     if 'user_id' not in session:
@@ -180,51 +626,36 @@ def variation():
 
     user_inputs = session['user_inputs']
     base_idea = session['current_meal_idea'] 
-    original_recipe_data = session['current_recipe_data'] 
     variation_prompt = request.form['variation_prompt']
 
-    # Corrected order for create_meal arguments
-    new_meal_idea = meal_suggestion_service.create_meal(
-        user_inputs['budget'], user_inputs['mood'], user_inputs['type_of_meal'], user_inputs['tools'],
-        user_inputs['time'], user_inputs['dietary_restrictions'],
-        base_idea=base_idea, variation_prompt=variation_prompt
-    )
+    new_meal_idea = get_prefetched_variation(session['user_id'], base_idea, variation_prompt)
+    genai_recipe_text = None
+    if not new_meal_idea:
+        # One call returns the variation idea and a recipe to fall back on if Tasty has no match
+        new_meal_idea, genai_recipe_text = meal_and_recipe(user_inputs, base_idea, variation_prompt)
 
     if not new_meal_idea:
         flash("Could not generate a variation idea. Please try again.", 'error')
 
-        formatted_recipe = format_recipe_for_display(original_recipe_data)
-        return render_template('recipe_details.html',
-                               meal_idea=base_idea, 
-                               recipe=formatted_recipe,
-                               user_inputs=user_inputs,
-                               show_save_options=True) 
+        # The original recipe stays on screen
+        return render_recipe_details()
 
 
     session['current_meal_idea'] = new_meal_idea
 
-    variation_recipe_data = recipe_creation_service.req_recipe_details(
-        new_meal_idea, user_inputs['type_of_meal'], user_inputs['budget'], user_inputs['tools'],
-        user_inputs['time'], user_inputs['dietary_restrictions']
-    )
+    variation_recipe_data = recipe_details(new_meal_idea, user_inputs, genai_recipe_text)
 
     if variation_recipe_data:
-        session['current_recipe_data'] = variation_recipe_data 
-        formatted_recipe = format_recipe_for_display(variation_recipe_data)
-        return render_template('recipe_details.html',
-                               meal_idea=new_meal_idea, 
-                               recipe=formatted_recipe,
-                               user_inputs=user_inputs,
-                               show_save_options=True) 
+        set_current_recipe(variation_recipe_data)
+        return render_recipe_details()
     else:
         flash(f"Could not find a recipe for the variation: '{new_meal_idea}'. Please try a different prompt.", 'error')
        
-        session.pop('current_recipe_data', None) # Clear it if no recipe found for this variation
-        return render_template('recipe_details.html',
-                               meal_idea=new_meal_idea, 
-                               recipe=None, # No recipe data to display
-                               user_inputs=user_inputs,
-                               show_save_options=False) # Don't offer to save if no recipe was found
+        # Clear it if no recipe found for this variation
+        session.pop('current_recipe_data', None)
+        session.pop('current_formatted_recipe', None)
+        # No recipe data to display, and nothing to offer saving
+        return render_recipe_details(recipe=None, show_save_options=False)
 
 
 @app.route('/save_current_recipe', methods=['POST'])
@@ -237,7 +668,7 @@ def save_current_recipe():
     user_inputs = session.get('user_inputs')
     recipe_data = session.get('current_recipe_data') 
 
-    if not all([meal_idea, user_inputs, recipe_data]):
+    if meal_idea is None or user_inputs is None or recipe_data is None:
         flash("No valid recipe data in session to save. Please generate a new one.", 'error')
         return redirect(url_for('create_recipe_page'))
 
@@ -250,11 +681,11 @@ def save_current_recipe():
             recipe_data=recipe_data, 
             user_id=user_id 
         )
+        invalidate(f"history:{user_id}")
+        queue_variation_prefetch(user_id, meal_idea, user_inputs)
         flash("Recipe saved successfully!", 'success')
      
-        session.pop('current_meal_idea', None)
-        session.pop('user_inputs', None)
-        session.pop('current_recipe_data', None)
+        clear_recipe_state()
     except ValueError as e: 
         flash(f"Error saving recipe: {e}", 'error')
     except Exception as e:
@@ -266,9 +697,7 @@ def save_current_recipe():
 @app.route('/discard_current_recipe', methods=['POST'])
 def discard_current_recipe():
 
-    session.pop('current_meal_idea', None)
-    session.pop('user_inputs', None)
-    session.pop('current_recipe_data', None)
+    clear_recipe_state()
     flash("Recipe discarded.", 'info')
     return redirect(url_for('create_recipe_page'))
 
@@ -280,10 +709,16 @@ def view_history():
         return redirect(url_for('login'))
 
     user_id = session['user_id'] 
-    history = db.meal_history(user_id) 
+    page = min(max(request.args.get('page', 1, type=int), 1), MAX_HISTORY_PAGE)
+    history, has_older = meal_history(user_id, page)
 
-
-    return render_template('history.html', history_data=history)
+    # The session is saved before a streamed body is sent, so pop the flashes now;
+    # the template's get_flashed_messages() then reads them from the request.
+    get_flashed_messages()
+    # Send the page as it renders so the browser can start on the top of a long history
+    return Response(stream_with_context(stream_template(
+        'history.html', history_data=history, page=page, has_older=has_older
+    )))
 
 
 @app.route('/delete_meal/<int:meal_id>', methods=['POST'])
@@ -296,6 +731,7 @@ def delete_meal(meal_id):
     try:
         success = db.delete_meal(meal_id, user_id)
         if success:
+            invalidate(f"history:{user_id}")
             flash(f'Recipe deleted successfully!', 'success')
         else:
             flash(f'Recipe not found or you do not have permission to delete it.', 'error')
@@ -308,72 +744,61 @@ def delete_meal(meal_id):
 
 
 
-def get_location_from_zip(zipcode, api_key):
-    """Converts a ZIP code to latitude and longitude using Google Geocoding API."""
-    geo_url = f"https://maps.googleapis.com/maps/api/geocode/json?address={zipcode}&key={api_key}"
+def _store_from_place(place):
+    """The fields the grocery list shows, taken from one Nearby Search or Text Search result."""
+    return {
+        "name": place.get("name", "Unknown Store"),
+        "address": place.get("vicinity") or place.get("formatted_address", "No address available"),
+        "open_now": place.get("opening_hours", {}).get("open_now"),
+        "google_maps_url": f"https://www.google.com/maps/place/?q=place_id:{place['place_id']}"
+    }
+
+
+def _search_places(url, params):
+    """
+    Runs one Places search and returns up to five stores built from its results.
+    The results already have everything the page shows, so no per-store Details calls are made.
+    """
     try:
-        geo_response = requests.get(geo_url).json()
-        if geo_response["status"] == "OK":
-            location = geo_response["results"][0]["geometry"]["location"]
-            return f"{location['lat']},{location['lng']}"
-        else:
-            print(f"Geocoding API error for ZIP {zipcode}: {geo_response.get('error_message', geo_response['status'])}")
-            return None
+        response = GOOGLE_HTTP.get(url, params=params, timeout=GOOGLE_TIMEOUT)
+        data = orjson.loads(response.content)
+
+        if data['status'] == 'OK':
+            return [_store_from_place(place) for place in data['results'][:5]]
+        logger.warning("Places API error: %s", data.get('error_message', data['status']))
+        return []
     except requests.exceptions.RequestException as e:
-        print(f"Network error during geocoding: {e}")
-        return None
-    except (KeyError, IndexError) as e:
-        print(f"Unexpected JSON structure from geocoding API: {e}")
-        return None
+        logger.warning("Network error during Places API call: %s", e)
+        return []
+    except (KeyError, IndexError, ValueError):
+        logger.exception("Unexpected JSON structure from Places API")
+        return []
 
 
+@local_cached(maxsize=2048, ttl=3600)
+@cached('places:{0}', ttl=3600)
 def find_grocery_stores(location, api_key):
-    """Finds nearby grocery stores using Google Places API."""
-    nearby_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-    nearby_params = {
+    """Finds grocery stores near a "lat,lng" location using Google Places Nearby Search."""
+    return _search_places(NEARBY_SEARCH_URL, {
         "location": location,
         "radius": 5000, 
         "type": "grocery_or_supermarket", 
         "key": api_key
-    }
-
-    try:
-        response = requests.get(nearby_url, params=nearby_params)
-        data = response.json()
-        stores = []
-
-        if data['status'] == 'OK':
-            for place in data['results'][:5]: 
-               
-                place_id = place['place_id']
-                details_url = "https://maps.googleapis.com/maps/api/place/details/json"
-                details_params = {
-                    "place_id": place_id,
-                    "fields": "name,vicinity,opening_hours,url", 
-                    "key": api_key
-                }
-                details_response = requests.get(details_url, params=details_params)
-                details_data = details_response.json()
-
-                if details_data['status'] == 'OK':
-                    result = details_data['result']
-                    hours = result.get('opening_hours', {}).get('weekday_text', ["Hours not available"])
-
-                    stores.append({
-                        "name": result.get("name", "Unknown Store"),
-                        "address": result.get("vicinity", "No address available"),
-                        "hours": hours,
-                        "google_maps_url": result.get("url", "#") 
-                    })
-        else:
-            print(f"Places API error: {data.get('error_message', data['status'])}")
-        return stores
-    except requests.exceptions.RequestException as e:
-        print(f"Network error during Places API call: {e}")
-        return []
-    except (KeyError, IndexError) as e:
-        print(f"Unexpected JSON structure from Places API: {e}")
-        return []
+    })
+
+
+@local_cached(maxsize=2048, ttl=3600)
+@cached('places_zip:{0}', ttl=3600)
+def find_grocery_stores_by_zip(zipcode, api_key):
+    """
+    Finds grocery stores near a ZIP code using Google Places Text Search, which resolves
+    the ZIP itself so no separate geocoding call is needed.
+    """
+    return _search_places(TEXT_SEARCH_URL, {
+        "query": f"grocery stores near {zipcode}",
+        "type": "grocery_or_supermarket",
+        "key": api_key
+    })
 
 
 @app.route('/grocery_near_me', methods=['POST'])
@@ -383,60 +808,40 @@ def grocery_near_me():
         return redirect(url_for('login'))
 
     try:
-     
-        meal_idea = session.get('current_meal_idea')
-        formatted_recipe = format_recipe_for_display(session.get('current_recipe_data'))
-        user_inputs = session.get('user_inputs')
-
         zipcode = request.form.get('zipcode')
         if not zipcode:
             flash("Please provide a ZIP code.", 'error')
-            return render_template('recipe_details.html',
-                                   meal_idea=meal_idea,
-                                   recipe=formatted_recipe,
-                                   user_inputs=user_inputs,
-                                   show_save_options=True) 
+            return render_recipe_details()
 
         if not GOOGLE_API_KEY:
             flash("Google API Key is not configured. Cannot find grocery stores.", 'error')
-            return render_template('recipe_details.html',
-                                   meal_idea=meal_idea,
-                                   recipe=formatted_recipe,
-                                   user_inputs=user_inputs,
-                                   show_save_options=True)
-
-        location = get_location_from_zip(zipcode, GOOGLE_API_KEY)
-        if not location:
-            flash("Invalid ZIP code or geocoding failed. Please try again.", 'error')
-            return render_template('recipe_details.html',
-                                   meal_idea=meal_idea,
-                                   recipe=formatted_recipe,
-                                   user_inputs=user_inputs,
-                                   show_save_options=True)
-
-        stores = find_grocery_stores(location, GOOGLE_API_KEY)
+            return render_recipe_details()
+
+        zip_match = ZIP_RE.fullmatch(zipcode.strip())
+        if not zip_match:
+            flash("Please enter a valid 5-digit ZIP code.", 'error')
+            return render_recipe_details()
+
+        zipcode = zip_match.group(1)
+        location = ZIP_CENTROIDS.get(zipcode)
+        if location:
+            stores = find_grocery_stores(location, GOOGLE_API_KEY)
+        else:
+            stores = find_grocery_stores_by_zip(zipcode, GOOGLE_API_KEY)
 
         if not stores:
             flash(f"No grocery stores found near {zipcode}. Try a different ZIP code.", 'info')
 
-        return render_template('recipe_details.html',
-                               meal_idea=meal_idea,
-                               recipe=formatted_recipe,
-                               user_inputs=user_inputs,
-                               show_save_options=True, 
-                               stores=stores,
-                               zipcode=zipcode) 
+        return render_recipe_details(stores=stores, zipcode=zipcode)
 
     except Exception as e:
         traceback.print_exc()
         flash(f"An error occurred while finding grocery stores: {e}", 'error')
    
-        return render_template('recipe_details.html',
-                               meal_idea=session.get('current_meal_idea'),
-                               recipe=format_recipe_for_display(session.get('current_recipe_data')),
-                               user_inputs=session.get('user_inputs'),
-                               show_save_options=True)
+        return render_recipe_details()
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py).
+    # The reloader would re-import this module in a child process and build every service twice.
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', use_reloader=False)
\ No newline at end of file
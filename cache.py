@@ -0,0 +1,93 @@
+import logging
+import os
+from functools import wraps
+from threading import Lock
+
+from cachetools import TTLCache
+
+import orjson
+import redis
+
+logger = logging.getLogger(__name__)
+
+redis_client = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+
+
+def cache_get(key):
+    """Returns the decoded value stored under key, or None on a miss or a Redis error."""
+    try:
+        hit = redis_client.get(key)
+        if hit is not None:
+            return orjson.loads(hit)
+    except redis.RedisError as e:
+        logger.warning("Cache read error for '%s': %s", key, e)
+    return None
+
+
+def cache_set(key, value, ttl):
+    """Stores value under key for ttl seconds as orjson-encoded JSON, ignoring Redis errors."""
+    try:
+        redis_client.setex(key, ttl, orjson.dumps(value))
+    except redis.RedisError as e:
+        logger.warning("Cache write error for '%s': %s", key, e)
+
+
+def cached(key_template, ttl):
+    """
+    Read-through Redis cache for lookups keyed by their positional arguments.
+    The arguments are formatted into key_template to build the cache key, so a
+    template may use only some of them (e.g. to leave an API key out of the key).
+    Results are stored as orjson-encoded JSON for ttl seconds; empty results are never cached so
+    failed or empty lookups always fall through to the wrapped function. If Redis
+    is unreachable, the wrapped function is called directly.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            key = key_template.format(*args)
+            hit = cache_get(key)
+            if hit is not None:
+                return hit
+
+            result = func(*args)
+
+            if result:
+                cache_set(key, result, ttl)
+            return result
+        return wrapper
+    return decorator
+
+
+def local_cached(maxsize, ttl):
+    """
+    In-process TTL cache for lookups keyed by their positional arguments, meant to sit
+    in front of cached() so hot keys skip the Redis round-trip as well. Like cached(),
+    empty results are never stored. Safe to share across worker threads.
+    """
+    def decorator(func):
+        store = TTLCache(maxsize=maxsize, ttl=ttl)
+        lock = Lock()
+
+        @wraps(func)
+        def wrapper(*args):
+            with lock:
+                hit = store.get(args)
+            if hit is not None:
+                return hit
+
+            result = func(*args)
+
+            if result:
+                with lock:
+                    store[args] = result
+            return result
+        return wrapper
+    return decorator
+
+
+def invalidate(key):
+    """Removes a cached entry, ignoring Redis connection errors."""
+    try:
+        redis_client.delete(key)
+    except redis.RedisError as e:
+        logger.warning("Cache invalidation error for '%s': %s", key, e)
@@ -1,39 +1,146 @@
 import sqlite3
-import json
+import logging
+import orjson
+import os
+import re
+import threading
 from contextlib import contextmanager
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from gevent import get_hub
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Argon2id at OWASP's minimum profile (19 MiB, 2 passes): a few ms per hash, where
+# werkzeug's 600k-round PBKDF2 took most of a second on every login.
+_ph = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+
+def _off_loop(func, *args):
+    """
+    Runs a CPU-bound call on gevent's pool of real OS threads and waits for it. argon2 releases
+    the GIL while hashing, so other greenlets keep serving requests instead of stalling behind it.
+    """
+    return get_hub().threadpool.apply(func, args)
+
+
+def _verify_argon2(password_hash, password):
+    # Caught here rather than by the caller so a wrong password isn't reported as a
+    # failed task by the thread pool
+    try:
+        return _ph.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+# The hot queries, kept as constants so every call hands sqlite3 the same string and
+# hits the connection's prepared-statement cache instead of re-parsing the SQL.
+_SQL_INSERT_USER = "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)"
+_SQL_GET_USER = "SELECT id, username, email, password_hash, created_at FROM users WHERE username = ?"
+_SQL_INSERT_MEAL = (
+    "INSERT INTO meals (user_id, meal_idea, user_inputs, recipe_data, prep_time, servings) VALUES (?, ?, ?, ?, ?, ?)"
+)
+_SQL_DELETE_MEAL = "DELETE FROM meals WHERE id = ? AND user_id = ?"
+# Bulk deletes pad their id list up to one of these sizes (with NULLs, which match nothing),
+# so only a handful of distinct statements ever reach the statement cache.
+_DELETE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+_SQL_DELETE_MEALS = {
+    size: f"DELETE FROM meals WHERE user_id = ? AND id IN ({', '.join('?' * size)})" for size in _DELETE_BUCKETS
+}
+_SQL_HISTORY = (
+    "SELECT id, meal_idea, user_inputs, recipe_data, timestamp FROM meals WHERE user_id = ? "
+    "ORDER BY timestamp DESC LIMIT ? OFFSET ?"
+)
+_SQL_HISTORY_SUMMARY = "SELECT id, meal_idea, prep_time, servings, timestamp FROM meals WHERE user_id = ? ORDER BY timestamp DESC"
+
+# SQLite names the column behind a failed UNIQUE constraint, e.g. "UNIQUE constraint failed: users.email"
+_UNIQUE_RE = re.compile(r"UNIQUE constraint failed: users\.(\w+)")
+
+
+def _as_int(value):
+    """Returns value as an int, or None for things like 'N/A' or '2-3'."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 
 class Database:
     def __init__(self, db_name="crave.db"):
         """
-        Initializes the Database class and ensures the necessary tables exist.
+        Initializes the Database class. Tables are created separately by
+        create_tables(), which the app exposes as the `flask init-db` command.
         """
         self.db_name = db_name
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        # Parsed (user_inputs, recipe_data) by meal id. Saved meals are never edited and ids are
+        # never reused, so entries can't go stale; deleted meals simply stop being looked up.
+        # Only touched while holding _lock.
+        self._parsed_meals = LRUCache(maxsize=2048)
 
-        self.create_tables()
+    def _connect(self):
+        """
+        Returns this process's connection, opening it on first use. It is not opened in
+        __init__ so a gunicorn master that preloads the app never hands one to its workers.
+        WAL lets the file be read while another process writes to it, and synchronous=NORMAL
+        only fsyncs at checkpoints instead of on every commit. SQLite only enforces the schema's
+        foreign keys (and their ON DELETE CASCADE) when asked to per connection. Transactions are managed
+        explicitly by _get_connection, so the driver's implicit ones are turned off.
+        """
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(
+                self.db_name, check_same_thread=False, isolation_level=None, cached_statements=256
+            )
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                PRAGMA cache_size=-20000;
+                PRAGMA temp_store=MEMORY;
+                PRAGMA mmap_size=268435456;
+                PRAGMA foreign_keys=ON;
+            """)
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
 
     @contextmanager
-    def _get_connection(self, autocommit=True):
+    def _get_connection(self, autocommit=True, readonly=False):
         """
-        A context manager to handle database connections.
-        It automatically handles commits, rollbacks, and closing the connection.
-        It also sets row_factory to sqlite3.Row for dictionary-like access.
+        A context manager to handle database access on the shared connection.
+        With autocommit, the block runs in one BEGIN IMMEDIATE/COMMIT transaction that is
+        rolled back on error; taking the write lock up front means another process can't make
+        it fail halfway with SQLITE_BUSY. Readonly blocks run their SELECTs without opening a
+        transaction. It holds a lock so only one request uses the connection at a time.
+        Rows come back as plain tuples; readers name their columns and unpack them by position.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        try:
-            yield conn
-            if autocommit:
-                conn.commit()
-        except sqlite3.Error as e:
-            print(f"Database connection error: {e}")
-            if conn:
-                conn.rollback()
-            raise 
-        finally:
-            if conn:
-                conn.close()
+        transaction = autocommit and not readonly
+        with self._lock:
+            conn = self._connect()
+            try:
+                if transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                yield conn
+                if transaction:
+                    conn.execute("COMMIT")
+            except sqlite3.IntegrityError:
+                # Constraint violations (e.g. a taken username) are expected and reported by
+                # the caller, so they are rolled back without an error log
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            except sqlite3.Error as e:
+                logger.error("Database connection error: %s", e)
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            except Exception:
+                # Never leave a half-finished transaction for the next caller to commit
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
 
     def create_tables(self):
         """
@@ -41,100 +148,126 @@ class Database:
         Includes robust error handling to immediately show issues during table creation.
         """
         try:
-            with self._get_connection() as conn: 
-                cursor = conn.cursor()
+            # executescript commits any open transaction before it runs, so the script
+            # brings its own BEGIN/COMMIT and the DDL still applies all-or-nothing
+            with self._get_connection(autocommit=False) as conn: 
+                conn.executescript("""
+                    BEGIN IMMEDIATE;
 
-          
-                cursor.execute("""
                     CREATE TABLE IF NOT EXISTS users (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         username TEXT UNIQUE NOT NULL,
                         email TEXT UNIQUE NOT NULL,
                         password_hash TEXT NOT NULL,
                         created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
+                    );
 
-     
-                cursor.execute("""
                     CREATE TABLE IF NOT EXISTS meals (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         user_id INTEGER NOT NULL, -- This column must be explicitly defined
                         meal_idea TEXT NOT NULL,
                         user_inputs TEXT NOT NULL,
                         recipe_data TEXT NOT NULL,
+                        prep_time INTEGER, -- Copied from recipe_data so listings don't parse the JSON
+                        servings INTEGER,
                         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                         FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-                    )
+                    );
+
+                    -- meal_history filters by user and sorts newest first; this index serves both
+                    CREATE INDEX IF NOT EXISTS idx_meals_user_ts ON meals (user_id, timestamp DESC);
+
+                    COMMIT;
                 """)
-                print("Database: Tables 'users' and 'meals' successfully created (or already existed).")
+
+                # Databases created before prep_time/servings existed get the columns added
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(meals)")}
+                for column in ('prep_time', 'servings'):
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE meals ADD COLUMN {column} INTEGER")
+                logger.info("Database: Tables 'users' and 'meals' successfully created (or already existed).")
         except sqlite3.Error as e:
-            print(f"*** FATAL DATABASE ERROR: Failed to create tables: {e} ***")
+            logger.critical("*** FATAL DATABASE ERROR: Failed to create tables: %s ***", e)
             
             raise
 
     def create_user(self, username, email, password):
         """Creates a new user account with a hashed password."""
+        # Hashed before taking the connection lock and SQLite's write lock, so only the INSERT waits on them
+        password_hash = _off_loop(_ph.hash, password)
         try:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
 
-                password_hash = generate_password_hash(password, method='pbkdf2:sha256')
-                cursor.execute(
-                    "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
-                    (username, email, password_hash)
-                )
+                cursor.execute(_SQL_INSERT_USER, (username, email, password_hash))
                 return cursor.lastrowid 
         except sqlite3.IntegrityError as e:
-           
-            if "username" in str(e).lower():
+            match = _UNIQUE_RE.search(e.args[0]) if e.args else None
+            column = match.group(1) if match else None
+            if column == "username":
                 raise ValueError("Username already exists. Please choose a different username.")
-            elif "email" in str(e).lower():
+            elif column == "email":
                 raise ValueError("Email address already registered. Please use a different email or login.")
             else:
                 raise ValueError(f"User creation failed due to data integrity issue: {e}")
         except sqlite3.Error as e:
-            print(f"Error creating user '{username}': {e}")
+            logger.error("Error creating user '%s': %s", username, e)
             raise ValueError(f"User creation failed due to database error: {e}")
 
     def get_user_by_username(self, username):
         """Retrieves a user's details by their username."""
         try:
-            with self._get_connection() as conn:
+            with self._get_connection(readonly=True) as conn:
              
                 cursor = conn.cursor()
-                cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+                cursor.execute(_SQL_GET_USER, (username,))
                 row = cursor.fetchone()
                 if row:
-                    return dict(row) 
+                    user_id, username, email, password_hash, created_at = row
+                    return {
+                        "id": user_id, "username": username, "email": email,
+                        "password_hash": password_hash, "created_at": created_at
+                    }
                 return None 
         except sqlite3.Error as e:
-            print(f"Error retrieving user '{username}': {e}")
+            logger.error("Error retrieving user '%s': %s", username, e)
             return None 
 
     def verify_password(self, user, password):
-        """Verifies a user's plain-text password against their stored hash."""
+        """
+        Verifies a user's plain-text password against their stored hash.
+        Accounts created before the switch to Argon2 still have werkzeug PBKDF2 hashes.
+        """
     
         if user and "password_hash" in user:
-            return check_password_hash(user["password_hash"], password)
+            password_hash = user["password_hash"]
+            if not password_hash.startswith("$argon2"):
+                return _off_loop(check_password_hash, password_hash, password)
+            return _off_loop(_verify_argon2, password_hash, password)
         return False 
 
     def save_meal(self, meal_idea, user_inputs, recipe_data, user_id):
         """
         Saves a meal and its associated data to the database, linked to a specific user.
         """
+        self.save_meals([(user_id, meal_idea, user_inputs, recipe_data)])
+
+    def save_meals(self, records):
+        """
+        Saves several meals in one transaction with a single executemany.
+        records is an iterable of (user_id, meal_idea, user_inputs, recipe_data) tuples.
+        """
         try:
             with self._get_connection() as conn:
-                cursor = conn.cursor()
-                user_inputs_json = json.dumps(user_inputs)
-                recipe_data_json = json.dumps(recipe_data)
-               
-                cursor.execute(
-                    "INSERT INTO meals (user_id, meal_idea, user_inputs, recipe_data) VALUES (?, ?, ?, ?)",
-                    (user_id, meal_idea, user_inputs_json, recipe_data_json)
-                )
+                conn.executemany(_SQL_INSERT_MEAL, [
+                    (
+                        user_id, meal_idea, orjson.dumps(user_inputs).decode(), orjson.dumps(recipe_data).decode(),
+                        _as_int(recipe_data.get('readyInMinutes')), _as_int(recipe_data.get('servings'))
+                    )
+                    for user_id, meal_idea, user_inputs, recipe_data in records
+                ])
         except sqlite3.Error as e:
-            print(f"Error saving meal '{meal_idea}' for user {user_id}: {e}")
+            logger.error("Error saving meals: %s", e)
             raise ValueError(f"Failed to save meal: {e}")
 
     def delete_meal(self, meal_id, user_id):
@@ -145,40 +278,82 @@ class Database:
             with self._get_connection() as conn:
                 cursor = conn.cursor()
 
-                cursor.execute("DELETE FROM meals WHERE id = ? AND user_id = ?", (meal_id, user_id))
+                cursor.execute(_SQL_DELETE_MEAL, (meal_id, user_id))
                 if cursor.rowcount > 0:
-                    print(f"Meal ID {meal_id} deleted successfully by user {user_id}.")
+                    logger.debug("Meal ID %s deleted successfully by user %s.", meal_id, user_id)
                     return True 
                 else:
-                    print(f"Meal ID {meal_id} not found or does not belong to user {user_id}.")
+                    logger.debug("Meal ID %s not found or does not belong to user %s.", meal_id, user_id)
                     return False 
         except sqlite3.Error as e:
-            print(f"Error deleting meal ID {meal_id} for user {user_id}: {e}")
+            logger.error("Error deleting meal ID %s for user %s: %s", meal_id, user_id, e)
             raise ValueError(f"Failed to delete meal: {e}") 
 
-    def meal_history(self, user_id):
+    def delete_meals(self, meal_ids, user_id):
         """
-        Retrieves all past meals for a specific user from the database.
-        Returns a list of dictionaries, including 'id' for deletion functionality on the frontend.
+        Deletes several of a user's meals in one transaction. Ids that don't exist or belong
+        to someone else are skipped. Returns the number of meals deleted.
         """
+        meal_ids = list(meal_ids)
+        largest = _DELETE_BUCKETS[-1]
+        deleted = 0
         try:
             with self._get_connection() as conn:
+                for start in range(0, len(meal_ids), largest):
+                    chunk = meal_ids[start:start + largest]
+                    size = next(size for size in _DELETE_BUCKETS if size >= len(chunk))
+                    chunk += [None] * (size - len(chunk))
+                    deleted += conn.execute(_SQL_DELETE_MEALS[size], (user_id, *chunk)).rowcount
+            logger.debug("Deleted %s of %s meals for user %s.", deleted, len(meal_ids), user_id)
+            return deleted
+        except sqlite3.Error as e:
+            logger.error("Error deleting meals for user %s: %s", user_id, e)
+            raise ValueError(f"Failed to delete meals: {e}")
+
+    def meal_history(self, user_id, limit=50, offset=0):
+        """
+        Yields a page of past meals for a specific user from the database, newest first, reading
+        and parsing one row at a time instead of building the whole list up front.
+        limit=-1 yields every meal from offset on.
+        Each item is a dictionary, including 'id' for deletion functionality on the frontend.
+        A meal's JSON is parsed once and the result reused on later calls, so callers must not
+        modify the returned user_inputs or recipe_data.
+        The shared connection stays locked until the generator is exhausted or closed, so
+        consume it right away (e.g. with list()).
+        """
+        try:
+            with self._get_connection(readonly=True) as conn:
                 cursor = conn.cursor()
              
-                cursor.execute(
-                    "SELECT id, meal_idea, user_inputs, recipe_data, timestamp FROM meals WHERE user_id = ? ORDER BY timestamp DESC",
-                    (user_id,)
-                )
-                rows = cursor.fetchall() 
-
-                history = []
-                for row in rows:
-                    parsed_row = dict(row) 
-               
-                    parsed_row["user_inputs"] = json.loads(parsed_row["user_inputs"])
-                    parsed_row["recipe_data"] = json.loads(parsed_row["recipe_data"])
-                    history.append(parsed_row)
-                return history
+                cursor.execute(_SQL_HISTORY, (user_id, limit, offset))
+
+                for meal_id, meal_idea, user_inputs, recipe_data, timestamp in cursor:
+                    parsed = self._parsed_meals.get(meal_id)
+                    if parsed is None:
+                        parsed = self._parsed_meals[meal_id] = (orjson.loads(user_inputs), orjson.loads(recipe_data))
+                    yield {
+                        "id": meal_id,
+                        "meal_idea": meal_idea,
+                        "user_inputs": parsed[0],
+                        "recipe_data": parsed[1],
+                        "timestamp": timestamp
+                    }
+        except sqlite3.Error as e:
+            logger.error("Error retrieving meal history for user %s: %s", user_id, e)
+
+    def meal_history_summary(self, user_id):
+        """
+        Retrieves the id, meal idea, prep time, servings and timestamp of a user's saved meals,
+        newest first, without reading or parsing the stored JSON. For listings that don't need
+        the full recipe; meal_history still returns everything.
+        """
+        try:
+            with self._get_connection(readonly=True) as conn:
+                cursor = conn.execute(_SQL_HISTORY_SUMMARY, (user_id,))
+                return [
+                    {"id": meal_id, "meal_idea": meal_idea, "prep_time": prep_time, "servings": servings, "timestamp": timestamp}
+                    for meal_id, meal_idea, prep_time, servings, timestamp in cursor
+                ]
         except sqlite3.Error as e:
-            print(f"Error retrieving meal history for user {user_id}: {e}")
-            return []
\ No newline at end of file
+            logger.error("Error retrieving meal history summary for user %s: %s", user_id, e)
+            return []
@@ -0,0 +1,26 @@
+import multiprocessing
+
+# Requests spend most of their time waiting on OpenAI, Tasty and Google, so use
+# cooperative gevent workers that keep many slow calls in flight per process.
+worker_class = 'gevent'
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_connections = 1000
+timeout = 60
+
+# Import app.py once in the master so the Database, CreateMeal and CreateRecipe
+# singletons are built a single time and shared copy-on-write by every worker.
+# Nothing at import time holds an open socket or SQLite handle, so this is fork-safe.
+preload_app = True
+
+# Never recycle workers on a request count; a long-lived worker keeps its warm
+# template and connection caches.
+max_requests = 0
+
+
+def when_ready(server):
+    """Renders the public pages once in the master so workers fork with compiled Jinja templates."""
+    from wsgi import app
+
+    with app.test_client() as client:
+        for path in ('/', '/about'):
+            client.get(path)
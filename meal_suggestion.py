@@ -1,7 +1,75 @@
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+import httpx
+import logging
+import orjson
 import os
 from dotenv import load_dotenv 
 
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying on the next prefetch run; anything else means the batch is gone for good.
+_TRANSIENT_BATCH_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+
+# The markdown layout CreateRecipe._loop_genai_recipe knows how to parse.
+RECIPE_FORMAT_LINES = [
+    "```",
+    " ~ Recipe Title: [Name of Meal] ~",
+    " Cook Time: [X] minutes",
+    " Servings: [Y]",
+    " Ingredients:",
+    "- [Quantity] [Unit] [Ingredient 1]",
+    "- [Quantity] [Unit] [Ingredient 2]",
+    "- ...",
+    "~ Instructions:~",
+    "1. [Step 1]",
+    "2. [Step 2]",
+    "3. ...",
+    "```",
+    "Ensure all sections are present and follow the markdown structure precisely."
+]
+
+# The static parts of every prompt, joined once at import; each call only fills in the user's values.
+RECIPE_FORMAT = "\n".join(RECIPE_FORMAT_LINES)
+
+_MEAL_GUIDELINES = (
+    "As a culinary assistant for college students, suggest a personalized meal idea "
+    "you will be FIRED and BARRED from the culinary practice unless your meal strictly follows these guidelines:\n"
+    "- Budget: {budget}\n"
+    "- Type of Meal: {type_of_meal}\n"
+    "- Mood: {mood}\n"
+    "- Kitchen tools available: {tools}\n"
+    "- Time: {time}\n"
+    "- Dietary restrictions: {dietary_restrictions}\n"
+    "- It is very important for regulations that you follow these restrictions to a T. Ensure that you return the steps in order, without numbering."
+)
+
+_MEAL_NAME_ONLY = "Please provide only the name of the meal, without any additional text or formatting."
+
+_MEAL_AND_RECIPE_FORMAT = "\n".join([
+    'Respond with a JSON object with two keys: "meal_idea", containing only the name of the meal, '
+    'and "recipe", containing the complete recipe for that meal as a single string in the following markdown format:',
+    RECIPE_FORMAT
+])
+
+_WHOLE_RECIPE_PROMPT = "\n".join([
+    "You are a helpful culinary assistant for a college students who experience different situations. Generate a complete recipe.",
+    "The meal idea is: '{meal_idea}'.",
+    "The type of meal is: '{type_of_meal}'.",
+    "The user's budget is: {budget}.",
+    "Available kitchen tools: {tools}.",
+    "The user wants to spend this amount of time in minutes: {time}.",
+    "Dietary restrictions: {dietary_restrictions}.",
+    "Please provide the recipe in the following markdown format:",
+    RECIPE_FORMAT
+])
+
+# A meal name is rarely over a dozen tokens; the stop sequence ends the completion if the
+# model starts adding a description on the next line anyway.
+_MEAL_NAME_PARAMS = {"max_tokens": 24, "temperature": 0.7, "stop": ["\n"]}
+
+_CULINARY_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful culinary assistant for college students."}
+_RECIPE_SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful culinary assistant."}
+
 class CreateMeal:
     def __init__(self):
        
@@ -10,85 +78,197 @@ class CreateMeal:
         openai_api_key = os.getenv("OPENAI_API_KEY")
         if not openai_api_key:
             raise ValueError("OPENAI_API_KEY not found in environment variables. Please set it in your .env file.")
-            
-        self.client = OpenAI(api_key=openai_api_key) 
+
+        self._api_key = openai_api_key
+        self._client = None
+        self._client_pid = None
         
         self.model_name = 'gpt-4o-mini' 
 
-    def create_meal(self, budget, mood, type_of_meal, tools, time, dietary_restrictions, base_idea=None, variation_prompt=None):
+    @property
+    def client(self):
         """
-        Generates a tailored meal idea based on user inputs using OpenAI API.
+        This process's OpenAI client, built on first use rather than in __init__, so a gunicorn
+        master that preloads the app doesn't construct one only for every worker to inherit it.
+        It keeps warm connections to the API around so back-to-back idea/recipe calls skip the
+        TLS handshake, and HTTP/2 lets the requests in flight from different greenlets share them.
         """
-        prompt = (
-            f"As a culinary assistant for college students, suggest a personalized meal idea "
-            f"you will be FIRED and BARRED from the culinary practice unless your meal strictly follows these guidelines:\n"
-            f"- Budget: {budget}\n"
-            f"- Type of Meal: {type_of_meal}\n"
-            f"- Mood: {mood}\n"
-            f"- Kitchen tools available: {', '.join(tools)}\n"
-            f"- Time: {time}\n"
-            f"- Dietary restrictions: {', '.join(dietary_restrictions) if dietary_restrictions else 'None'}\n"
-            f"- It is very important for regulations that you follow these restrictions to a T. Ensure that you return the steps in order, without numbering."
+        if self._client is None or self._client_pid != os.getpid():
+            self._client = OpenAI(
+                api_key=self._api_key,
+                http_client=httpx.Client(http2=True, limits=httpx.Limits(max_connections=64, max_keepalive_connections=32))
+            )
+            self._client_pid = os.getpid()
+        return self._client
+
+    def _meal_guidelines(self, budget, mood, type_of_meal, tools, time, dietary_restrictions):
+        """
+        The user's constraints, shared by every prompt that picks a meal.
+        """
+        return _MEAL_GUIDELINES.format(
+            budget=budget, type_of_meal=type_of_meal, mood=mood, tools=', '.join(tools), time=time,
+            dietary_restrictions=', '.join(dietary_restrictions) if dietary_restrictions else 'None'
         )
+
+    def _meal_messages(self, budget, mood, type_of_meal, tools, time, dietary_restrictions, base_idea=None, variation_prompt=None):
+        """
+        Builds the chat messages asking for a single meal name, optionally as a variation of base_idea.
+        """
+        prompt = self._meal_guidelines(budget, mood, type_of_meal, tools, time, dietary_restrictions)
        
         if base_idea and variation_prompt:
             prompt += f"Based on '{base_idea}', suggest a variation that is the same meal as '{base_idea}' but with the '{variation_prompt}' alteration.\n"
 
-        prompt += "Please provide only the name of the meal, without any additional text or formatting."
+        prompt += _MEAL_NAME_ONLY
 
-        messages = [
-            {"role": "system", "content": "You are a helpful culinary assistant for college students."},
-            {"role": "user", "content": prompt}
-        ]
+        return [_CULINARY_SYSTEM_MESSAGE, {"role": "user", "content": prompt}]
+
+    def create_meal(self, budget, mood, type_of_meal, tools, time, dietary_restrictions, base_idea=None, variation_prompt=None):
+        """
+        Generates a tailored meal idea based on user inputs using OpenAI API.
+        """
+        messages = self._meal_messages(
+            budget, mood, type_of_meal, tools, time, dietary_restrictions, base_idea, variation_prompt
+        )
 
         try:
             response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=messages,
-                max_tokens=50,
-                temperature=0.7
+                **_MEAL_NAME_PARAMS
             )
             meal_idea = response.choices[0].message.content.strip()
             return meal_idea
-        except Exception as e:
-            print(f"Error generating meal idea with OpenAI: {e}")
+        except Exception:
+            logger.exception("Error generating meal idea with OpenAI")
+            return None
+
+    def create_meal_and_recipe(self, budget, mood, type_of_meal, tools, time, dietary_restrictions, base_idea=None, variation_prompt=None):
+        """
+        Generates a meal idea (optionally a variation of base_idea) and its full recipe in one
+        OpenAI call using JSON mode, saving the round trip of asking for the recipe separately.
+        Returns (meal_idea, recipe_text); both are None if the call fails. A reply that was cut
+        off or is not valid JSON falls back to create_meal followed by create_whole_recipe.
+        """
+        guidelines = self._meal_guidelines(budget, mood, type_of_meal, tools, time, dietary_restrictions)
+        if base_idea and variation_prompt:
+            guidelines += f"\nBased on '{base_idea}', suggest a variation that is the same meal as '{base_idea}' but with the '{variation_prompt}' alteration."
+
+        messages = [_CULINARY_SYSTEM_MESSAGE, {"role": "user", "content": f"{guidelines}\n{_MEAL_AND_RECIPE_FORMAT}"}]
+
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=2000,
+                temperature=0.7,
+                response_format={"type": "json_object"}
+            )
+        except Exception:
+            logger.exception("Error generating meal idea and recipe with OpenAI")
+            return None, None
+
+        choice = response.choices[0]
+        try:
+            if choice.finish_reason == "length":
+                raise ValueError("reply was truncated")
+            result = orjson.loads(choice.message.content)
+            meal_idea = (result.get("meal_idea") or "").strip()
+            recipe_text = (result.get("recipe") or "").strip()
+        except (ValueError, AttributeError) as e:
+            logger.warning("Falling back to separate meal and recipe calls: %s", e)
+            meal_idea = self.create_meal(
+                budget, mood, type_of_meal, tools, time, dietary_restrictions, base_idea, variation_prompt
+            )
+            if not meal_idea:
+                return None, None
+            return meal_idea, self.create_whole_recipe(meal_idea, type_of_meal, budget, tools, time, dietary_restrictions)
+
+        if not meal_idea:
+            return None, None
+        return meal_idea, recipe_text or None
+
+    def submit_variation_batch(self, jobs):
+        """
+        Submits variation meal-idea requests to the OpenAI Batch API, which is cheaper than
+        live calls but finishes asynchronously (within 24h).
+        jobs maps a custom_id to a dict of create_meal keyword arguments.
+        Returns the batch id, or None if the submission failed.
+        """
+        lines = []
+        for custom_id, job in jobs.items():
+            lines.append(orjson.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "messages": self._meal_messages(**job),
+                    **_MEAL_NAME_PARAMS
+                }
+            }))
+
+        try:
+            batch_file = self.client.files.create(file=("variations.jsonl", b"\n".join(lines)), purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            return batch.id
+        except Exception:
+            logger.exception("Error submitting variation batch to OpenAI")
             return None
 
+    def collect_variation_batch(self, batch_id):
+        """
+        Returns {custom_id: meal_idea} for a completed batch, {} if it ended without usable
+        output, or None while it is still running or OpenAI could not be reached.
+        """
+        try:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in ("validating", "in_progress", "finalizing"):
+                return None
+            if batch.status != "completed" or not batch.output_file_id:
+                logger.warning("Variation batch %s ended with status '%s'.", batch_id, batch.status)
+                return {}
+
+            results = {}
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                body = (item.get("response") or {}).get("body") or {}
+                if body.get("choices"):
+                    results[item["custom_id"]] = body["choices"][0]["message"]["content"].strip()
+            return results
+        except _TRANSIENT_BATCH_ERRORS as e:
+            logger.warning("Could not reach OpenAI for variation batch %s: %s", batch_id, e)
+            return None
+        except Exception:
+            logger.exception("Dropping variation batch %s after an unrecoverable error", batch_id)
+            return {}
+
+    def _whole_recipe_messages(self, meal_idea, type_of_meal, budget, tools, time, dietary_restrictions):
+        """
+        Builds the chat messages asking for a full recipe in the markdown format
+        that CreateRecipe._loop_genai_recipe parses.
+        """
+        prompt = _WHOLE_RECIPE_PROMPT.format(
+            meal_idea=meal_idea, type_of_meal=type_of_meal, budget=budget,
+            tools=', '.join(tools) if tools else 'None specified', time=time,
+            dietary_restrictions=', '.join(dietary_restrictions) if dietary_restrictions else 'None specified'
+        )
+
+        return [_RECIPE_SYSTEM_MESSAGE, {"role": "user", "content": prompt}]
+
     def create_whole_recipe(self, meal_idea, type_of_meal, budget, tools, time, dietary_restrictions):
         """
         Generates a full recipe including ingredients, instructions, and cook time
         for a given meal idea, incorporating budget, tools, and dietary restrictions,
         using OpenAI API.
         """
-        prompt_parts = [
-            "You are a helpful culinary assistant for a college students who experience different situations. Generate a complete recipe.",
-            f"The meal idea is: '{meal_idea}'.",
-            f"The type of meal is: '{type_of_meal}'.",
-            f"The user's budget is: {budget}.",
-            f"Available kitchen tools: {', '.join(tools) if tools else 'None specified'}.",
-            f"The user wants to spend this amount of time in minutes: {time}.",
-            f"Dietary restrictions: {', '.join(dietary_restrictions) if dietary_restrictions else 'None specified'}.",
-            "Please provide the recipe in the following markdown format:",
-            "```",
-            " ~ Recipe Title: [Name of Meal] ~",
-            " Cook Time: [X] minutes",
-            " Servings: [Y]",
-            " Ingredients:",
-            "- [Quantity] [Unit] [Ingredient 1]",
-            "- [Quantity] [Unit] [Ingredient 2]",
-            "- ...",
-            "~ Instructions:~",
-            "1. [Step 1]",
-            "2. [Step 2]",
-            "3. ...",
-            "```",
-            "Ensure all sections are present and follow the markdown structure precisely."
-        ]
-        
-        messages = [
-            {"role": "system", "content": "You are a helpful culinary assistant."},
-            {"role": "user", "content": "\n".join(prompt_parts)}
-        ]
+        messages = self._whole_recipe_messages(meal_idea, type_of_meal, budget, tools, time, dietary_restrictions)
 
         try:
             response = self.client.chat.completions.create(
@@ -98,10 +278,31 @@ class CreateMeal:
                 temperature=0.7
             )
             return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"Error generating full recipe with OpenAI: {e}")
+        except Exception:
+            logger.exception("Error generating full recipe with OpenAI")
             return None
 
+    def stream_whole_recipe(self, meal_idea, type_of_meal, budget, tools, time, dietary_restrictions):
+        """
+        Same as create_whole_recipe, but yields the recipe text in chunks as OpenAI
+        generates it. Yields nothing if the request fails.
+        """
+        messages = self._whole_recipe_messages(meal_idea, type_of_meal, budget, tools, time, dietary_restrictions)
+
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                max_tokens=1000,
+                temperature=0.7,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception:
+            logger.exception("Error streaming full recipe with OpenAI")
+
 # Example Usage
 if __name__ == "__main__":
     
@@ -1,11 +1,62 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-import json
+import re
+import logging
+import orjson
+import gevent
+from gevent.pool import Pool
 from meal_suggestion import CreateMeal
+from cache import cached, cache_get
+from utils import normalize_meal_idea
 from dotenv import load_dotenv 
 
+logger = logging.getLogger(__name__)
+
+# Tasty recipes rarely change, so parsed search hits and recipe details are kept for a week
+TASTY_TTL = 86400 * 7
+
+# Crave recipe field, Tasty field it comes from, and the value used when Tasty leaves it out
+_TASTY_FIELDS = (
+    ('title', 'name', 'N/A'),
+    ('servings', 'num_servings', 'N/A'),
+    ('readyInMinutes', 'total_time_minutes', 'N/A'),
+    ('sourceUrl', 'canonical_url', 'N/A'),
+    ('image', 'thumbnail_url', None),
+)
+
+# The section headers of RECIPE_FORMAT_LINES; one match per line finds the header and its text
+_GENAI_SECTION_RE = re.compile(r'(~ Recipe Title:|Cook Time:|Servings:|Ingredients:|~ Instructions:~)(.*)')
+# A cook time that is just a number of minutes, e.g. "15 minutes"; anything else is kept as text
+_COOK_MINUTES_RE = re.compile(r'(\d+)\s*minutes', re.IGNORECASE)
+_GENAI_SECTIONS = {
+    "~ Recipe Title:": 'title',
+    "Cook Time:": 'cook_time',
+    "Servings:": 'servings',
+    "Ingredients:": 'ingredients',
+    "~ Instructions:~": 'instructions',
+}
+
+def _log_request_error(message, e):
+    """Logs a failed Tasty request; the response body is only read when DEBUG logging is on."""
+    if e.response is not None:
+        logger.error("%s: %s", message, e.response.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Tasty response body: %s", e.response.text)
+    else:
+        logger.error("%s: %s", message, e)
+
+
+def _log_decode_error(message, e, response):
+    """Logs a Tasty response that wasn't valid JSON, with the raw body at DEBUG."""
+    logger.error("%s: %s", message, e)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw Tasty response: %s", response.text)
+
+
 class CreateRecipe:
-    def __init__(self):
+    def __init__(self, meal_suggestion=None):
        
         load_dotenv()
 
@@ -16,49 +67,49 @@ class CreateRecipe:
         self.api_host = "tasty.p.rapidapi.com"
 
         self.base_url = f"https://{self.api_host}"
+        self.search_url = f"{self.base_url}/recipes/list"
+        self.detail_url = f"{self.base_url}/recipes/get-more-info"
 
         self.headers = {
             "X-RapidAPI-Host": self.api_host,
             "X-RapidAPI-Key": self.api_key
         }
 
-        self.meal_suggestion = CreateMeal()
+        # One keep-alive session for every Tasty call, so the search and the detail lookup
+        # that follows it reuse a TCP/TLS connection. Transient 429/5xx responses are retried
+        # with a short exponential backoff.
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=64,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        self.timeout = (3, 10)  # (connect, read) seconds
 
-   
-    def _convert_sets_to_lists(self, obj):
-        """
-        Recursively converts set objects within a dictionary, list, or set
-        to list objects, making them JSON serializable.
-        """
-        if isinstance(obj, set):
-            return list(obj)
-        elif isinstance(obj, dict):
-            return {k: self._convert_sets_to_lists(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [self._convert_sets_to_lists(elem) for elem in obj]
-        else:
-            return obj
+        # Share the app's CreateMeal (and its OpenAI connection pool) when one is given
+        self.meal_suggestion = meal_suggestion or CreateMeal()
 
-    def req_recipe_details(self, meal_idea, type_of_meal, budget, tools, time, dietary_restrictions):
+    def _search_tasty(self, meal_idea):
         """
-        Fetches recipe details from Tasty API based on the meal idea and user preferences.
-        If Tasty API fails or returns no results, it falls back to GenAI.
-        Ensures the returned recipe data is JSON serializable.
+        Searches Tasty for the meal idea and returns the first match parsed into
+        Crave's recipe format, or None if nothing suitable was found.
+        Matches are cached in Redis by the normalized meal idea.
         """
-        search_url = f"https://{self.api_host}/recipes/list"
-        search_params = {
-            "from": "0",
-            "size": "1",
-            "q": meal_idea
-        }
+        return self._tasty_search(normalize_meal_idea(meal_idea), meal_idea.strip())
 
-        print(f"Searching Tasty for: '{meal_idea}'")
+    @cached('tasty:search:{1}', ttl=TASTY_TTL)
+    def _tasty_search(self, key, meal_idea):
+        # Only the best match is needed
+        search_params = (("from", "0"), ("size", "1"), ("q", meal_idea))
+
+        logger.debug("Searching Tasty for: '%s'", meal_idea)
 
         tasty_recipe = None
         try:
-            response = requests.get(search_url, headers=self.headers, params=search_params)
+            response = self.session.get(self.search_url, params=search_params, timeout=self.timeout)
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
 
             if data and data.get('results'):
                 first_result = data['results'][0]
@@ -66,106 +117,143 @@ class CreateRecipe:
                 recipe_name = first_result.get('name')
 
                 if recipe_id:
-                    print(f"Found recipe: '{recipe_name}' (ID: {recipe_id}). Fetching details from Tasty...")
+                    logger.debug("Found recipe: '%s' (ID: %s). Fetching details from Tasty...", recipe_name, recipe_id)
                     tasty_recipe = self._req_recipe_by_id(recipe_id)
                 else:
-                    print("No ID found for the first recipe result from Tasty.")
+                    logger.warning("No ID found for the first recipe result from Tasty.")
             else:
-                print(f"No suitable recipes found on Tasty for '{meal_idea}'.")
+                logger.debug("No suitable recipes found on Tasty for '%s'.", meal_idea)
 
         except requests.exceptions.RequestException as e:
-            if e.response is not None:
-                print(f"Error fetching recipe from Tasty API: {e.response.status_code} - {e.response.text}")
-            else:
-                print(f"Error fetching recipe from Tasty API: {e}")
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON response from Tasty API: {e}. Raw response: {response.text if 'response' in locals() else 'No response object.'}")
+            _log_request_error("Error fetching recipe from Tasty API", e)
+        except orjson.JSONDecodeError as e:
+            _log_decode_error("Error decoding JSON response from Tasty API", e, response)
+
+        return tasty_recipe
+
+    def req_recipe_details(self, meal_idea, type_of_meal, budget, tools, time, dietary_restrictions, genai_recipe_text=None):
+        """
+        Fetches recipe details from Tasty API based on the meal idea and user preferences.
+        If Tasty API fails or returns no results, it falls back to GenAI. A recipe the caller
+        already generated (genai_recipe_text) is used as that fallback instead of a new call.
+        Otherwise, when Tasty has to be searched over the network (the search isn't cached), the
+        GenAI recipe is requested alongside it, so a miss costs the slower of the two calls
+        rather than both; it is abandoned if Tasty finds a match.
+        The returned recipe data is built from plain dicts, lists and strings, so it is
+        JSON serializable as is.
+        """
+        # A cached Tasty match answers straight away, with no OpenAI request to waste
+        tasty_recipe = cache_get(f"tasty:search:{normalize_meal_idea(meal_idea)}")
+        if tasty_recipe:
+            return tasty_recipe
+
+        genai_job = None
+        if not genai_recipe_text:
+            genai_job = gevent.spawn(
+                self.meal_suggestion.create_whole_recipe,
+                meal_idea, type_of_meal, budget, tools, time, dietary_restrictions
+            )
+
+        tasty_recipe = self._search_tasty(meal_idea)
 
         final_recipe_data = None
         if tasty_recipe:
+            if genai_job:
+                genai_job.kill(block=False)
             final_recipe_data = tasty_recipe
         else:
-            print("Will Generate a recipe based on your needs!")
-            genai_recipe_text = self.meal_suggestion.create_whole_recipe(
-                meal_idea, type_of_meal, budget, tools, time, dietary_restrictions
-            )
+            if genai_job:
+                logger.debug("Will Generate a recipe based on your needs!")
+                genai_recipe_text = genai_job.get()
 
             if genai_recipe_text:
-                print("AI-generated recipe received. Parsing...")
+                logger.debug("AI-generated recipe received. Parsing...")
                 final_recipe_data = self._loop_genai_recipe(genai_recipe_text)
             else:
-                print("Failed to generate a full recipe from AI.")
+                logger.warning("Failed to generate a full recipe from AI.")
                 final_recipe_data = None
-        # Recursively convert any sets to lists before returning
-        if final_recipe_data:
-            return self._convert_sets_to_lists(final_recipe_data)
+        return final_recipe_data or None
+
+    def req_many(self, recipe_requests, concurrency=10):
+        """
+        Runs req_recipe_details for several meals at once, e.g. a week of planned meals.
+        recipe_requests is a list of argument tuples for req_recipe_details; the results come
+        back in the same order. At most `concurrency` lookups are in flight at a time, to stay
+        inside the RapidAPI rate limit.
+        """
+        return Pool(concurrency).map(lambda args: self.req_recipe_details(*args), recipe_requests)
+
+    def stream_recipe_details(self, meal_idea, type_of_meal, budget, tools, time, dietary_restrictions):
+        """
+        Streaming counterpart of req_recipe_details for the live recipe view.
+        Yields ('chunk', text) events while a GenAI fallback recipe is being written,
+        then a final ('recipe', recipe_data) event, where recipe_data is None on failure.
+        Tasty hits produce only the final event.
+        """
+        tasty_recipe = self._search_tasty(meal_idea)
+        if tasty_recipe:
+            yield 'recipe', tasty_recipe
+            return
+
+        logger.debug("Will Generate a recipe based on your needs!")
+        genai_chunks = []
+        for chunk in self.meal_suggestion.stream_whole_recipe(
+            meal_idea, type_of_meal, budget, tools, time, dietary_restrictions
+        ):
+            genai_chunks.append(chunk)
+            yield 'chunk', chunk
+
+        genai_recipe_text = "".join(genai_chunks).strip()
+        if genai_recipe_text:
+            logger.debug("AI-generated recipe received. Parsing...")
+            yield 'recipe', self._loop_genai_recipe(genai_recipe_text)
         else:
-            return None
+            logger.warning("Failed to generate a full recipe from AI.")
+            yield 'recipe', None
 
+    @cached('tasty:recipe:{1}', ttl=TASTY_TTL)
     def _req_recipe_by_id(self, recipe_id):
         """
-        Fetches detailed recipe information for a given recipe ID from Tasty API.
+        Fetches detailed recipe information for a given recipe ID from Tasty API,
+        cached in Redis already parsed.
         """
-        detail_url = f"https://{self.api_host}/recipes/get-more-info"
-        detail_params = {
-            "id": str(recipe_id)
-        }
-
         try:
-            response = requests.get(detail_url, headers=self.headers, params=detail_params)
+            response = self.session.get(self.detail_url, params=(("id", str(recipe_id)),), timeout=self.timeout)
             response.raise_for_status()
-            recipe_data = response.json()
+            recipe_data = orjson.loads(response.content)
 
             if recipe_data:
                 return self._loop_tasty_recipe(recipe_data)
             else:
-                print(f"No detailed information found for recipe ID: {recipe_id}")
+                logger.warning("No detailed information found for recipe ID: %s", recipe_id)
                 return None
         except requests.exceptions.RequestException as e:
-            if e.response is not None:
-                print(f"Error fetching detailed recipe by ID from Tasty API: {e.response.status_code} - {e.response.text}")
-            else:
-                print(f"Error fetching detailed recipe by ID from Tasty API: {e}")
+            _log_request_error("Error fetching detailed recipe by ID from Tasty API", e)
             return None
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON response from Tasty API for ID {recipe_id}: {e}. Raw response: {response.text if 'response' in locals() else 'No response object.'}")
+        except orjson.JSONDecodeError as e:
+            _log_decode_error(f"Error decoding JSON response from Tasty API for ID {recipe_id}", e, response)
             return None
 
     def _loop_tasty_recipe(self, tasty_data):
         """
         Parses the raw JSON data from Tasty API into a consistent dictionary format for Crave.
         """
-        looped_recipe = {
-            'title': tasty_data.get('name', 'N/A'),
-            'servings': tasty_data.get('num_servings', 'N/A'),
-            'readyInMinutes': tasty_data.get('total_time_minutes', 'N/A'),
-            'sourceUrl': tasty_data.get('canonical_url', 'N/A'),
-            'image': tasty_data.get('thumbnail_url', None),
-            'extendedIngredients': [],
-            'instructions': '',
-        }
+        looped_recipe = {field: tasty_data.get(tasty_field, default) for field, tasty_field, default in _TASTY_FIELDS}
+
+        looped_recipe['extendedIngredients'] = [
+            {'originalName': ingredient_name, 'amount': '', 'unit': ''}
+            for section in tasty_data.get('sections', ())
+            for component in section.get('components', ())
+            if (ingredient_name := component.get('raw_text', ''))
+        ]
 
-        # Ingredients parsing
-        if 'sections' in tasty_data:
-            for section in tasty_data['sections']:
-                if 'components' in section:
-                    for component in section['components']:
-                        ingredient_name = component.get('raw_text', '')
-                        if ingredient_name:
-                            looped_recipe['extendedIngredients'].append({
-                                'originalName': ingredient_name,
-                                'amount': '',
-                                'unit': ''
-                            })
-
-        # Instructions parsing
+        # Steps keep their position in Tasty's list, so a blank step leaves a gap in the numbering
         if 'instructions' in tasty_data:
-            steps_list = []
-            for i, instruction_step in enumerate(tasty_data['instructions']):
-                display_text = instruction_step.get('display_text', '').strip()
-                if display_text:
-                    steps_list.append(f"Step {i+1}: {display_text}")
-            looped_recipe['instructions'] = "\n".join(steps_list)
+            looped_recipe['instructions'] = "\n".join([
+                f"Step {i}: {display_text}"
+                for i, instruction_step in enumerate(tasty_data['instructions'], 1)
+                if (display_text := instruction_step.get('display_text', '').strip())
+            ])
         else:
             looped_recipe['instructions'] = "No detailed instructions available."
 
@@ -175,7 +263,6 @@ class CreateRecipe:
         """
         Parses the markdown-formatted text response from GenAI into a dictionary
         consistent with the expected recipe structure for Crave.
-        Ensures the returned dictionary is JSON serializable.
         """
         looped_ai_recipe = {
             'title': 'meal_idea',
@@ -186,44 +273,21 @@ class CreateRecipe:
             'instructions': '',
         }
 
-        lines = genai_text.split('\n')
+        instruction_lines = []
         current_section = None
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-
-            # Check for recipe title
-            if line.startswith("~ Recipe Title:"):
-                try:
-                    looped_ai_recipe['title'] = line.replace("~ Recipe Title:", "").replace("~", "").strip()
-                except IndexError:
-                    pass # Handle cases where title might not be perfectly formatted
-                current_section = 'title'
-            # Check for cook time
-            elif line.startswith("Cook Time:"):
-                time_str = line.replace("Cook Time:", "").strip()
-                if "minutes" in time_str.lower():
-                    try:
-                        looped_ai_recipe['readyInMinutes'] = int(time_str.lower().replace("minutes", "").strip())
-                    except ValueError:
-                        looped_ai_recipe['readyInMinutes'] = time_str 
-                else:
-                    looped_ai_recipe['readyInMinutes'] = time_str
-                current_section = 'cook_time'
-            # Check for servings
-            elif line.startswith("Servings:"):
-                looped_ai_recipe['servings'] = line.replace("Servings:", "").strip()
-                current_section = 'servings'
-            # Check for ingredients section
-            elif line.startswith("Ingredients:"):
-                current_section = 'ingredients'
-            # Check for instructions section
-            elif line.startswith("~ Instructions:~"):
-                current_section = 'instructions'
-            # Handle numbered instruction steps (e.g., "1. First step")
-            elif current_section == 'instructions' and line.startswith(('1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.', '10.')):
-                looped_ai_recipe['instructions'] += line + "\n"
+        for line in filter(None, map(str.strip, genai_text.splitlines())):
+
+            header = _GENAI_SECTION_RE.match(line)
+            if header:
+                current_section = _GENAI_SECTIONS[header.group(1)]
+                rest = header.group(2).strip()
+                if current_section == 'title':
+                    looped_ai_recipe['title'] = rest.replace("~", "").strip()
+                elif current_section == 'cook_time':
+                    minutes = _COOK_MINUTES_RE.fullmatch(rest)
+                    looped_ai_recipe['readyInMinutes'] = int(minutes.group(1)) if minutes else rest
+                elif current_section == 'servings':
+                    looped_ai_recipe['servings'] = rest
             # Handle ingredient list items
             elif current_section == 'ingredients' and line.startswith('- '):
                 looped_ai_recipe['extendedIngredients'].append({
@@ -231,12 +295,10 @@ class CreateRecipe:
                     'amount': '',
                     'unit': ''
                 })
-
+            # Every other line under the instructions header, numbered or not, is part of them
             elif current_section == 'instructions':
-                looped_ai_recipe['instructions'] += line + "\n"
-          
-           
-        looped_ai_recipe['instructions'] = looped_ai_recipe['instructions'].strip()
-        
-       
-        return self._convert_sets_to_lists(looped_ai_recipe)
\ No newline at end of file
+                instruction_lines.append(line)
+
+        looped_ai_recipe['instructions'] = "\n".join(instruction_lines)
+
+        return looped_ai_recipe
\ No newline at end of file
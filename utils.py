@@ -1,45 +1,129 @@
+import csv
+import logging
+import os
+import re
+from threading import Lock
+
+from cachetools import LRUCache
+from markupsafe import escape
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Splitting on the comma and its surrounding whitespace trims every item in the same pass
+_CSV_SPLIT = re.compile(r'\s*,\s*').split
+
+# Runs of letters and digits in any script (\w minus the underscore)
+_MEAL_WORDS = re.compile(r'[^\W_]+').findall
+_MEAL_FILLER_WORDS = frozenset(('a', 'an', 'the'))
+
+
+def parse_csv(value):
+    """
+    Splits a comma-separated form field into a list of trimmed, non-empty items.
+    e.g. "microwave, , fork" -> ["microwave", "fork"]
+    """
+    return [t for t in _CSV_SPLIT(value.strip()) if t]
+
+
+def normalize_meal_idea(meal_idea):
+    """
+    A cache key for a meal idea that ignores case, punctuation, word order and articles, so
+    near-identical ideas share cached recipes. Letters in every script count as words; an idea
+    with no words at all keys on its own trimmed text rather than on an empty string.
+    e.g. "Stir-Fry, Chicken" and "the chicken stir fry" -> "chicken fry stir"
+    """
+    folded = meal_idea.casefold()
+    return ' '.join(sorted(set(_MEAL_WORDS(folded)) - _MEAL_FILLER_WORDS)) or folded.strip()
+
+
+def load_zip_centroids(path):
+    """
+    Loads a Census Gazetteer ZCTA file (tab-separated, with GEOID, INTPTLAT and INTPTLONG
+    columns) into a {zip: "lat,lng"} dict. Returns an empty dict if the file isn't there, in
+    which case the grocery search falls back to a Places Text Search on the raw ZIP code.
+    """
+    if not os.path.exists(path):
+        logger.warning("ZIP centroid file '%s' not found; every ZIP code will be looked up with a Places Text Search.", path)
+        return {}
+
+    centroids = {}
+    with open(path, newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = [name.strip() for name in next(reader)]
+        zip_col, lat_col, lng_col = header.index('GEOID'), header.index('INTPTLAT'), header.index('INTPTLONG')
+        for row in reader:
+            centroids[row[zip_col].strip()] = f"{float(row[lat_col])},{float(row[lng_col])}"
+    logger.info("Loaded %d ZIP centroids from '%s'.", len(centroids), path)
+    return centroids
+
+
+# Formatted recipes keyed by their canonical JSON, so the same recipe is only formatted once
+_FORMAT_CACHE = LRUCache(maxsize=512)
+_FORMAT_CACHE_LOCK = Lock()
+
+
 def format_recipe_for_display(recipe_data):
     """
     Formats the detailed recipe information for display in HTML.
     Returns an HTML string or a dictionary of formatted parts.
+    Results are memoized, so callers must not modify the returned dictionary.
     """
     if not recipe_data:
         return "No recipe data to display."
 
-    ingredients_html = "<ul>"
+    key = orjson.dumps(recipe_data, option=orjson.OPT_SORT_KEYS)
+    with _FORMAT_CACHE_LOCK:
+        formatted = _FORMAT_CACHE.get(key)
+    if formatted is None:
+        formatted = _format_recipe(recipe_data)
+        with _FORMAT_CACHE_LOCK:
+            _FORMAT_CACHE[key] = formatted
+    return formatted
+
+
+# Nutrients worth showing on the recipe card
+_SHOWN_NUTRIENTS = frozenset(('Calories', 'Protein', 'Fat', 'Carbohydrates', 'Summary'))
+
+
+def _format_recipe(recipe_data):
+    """
+    Builds the formatted parts of format_recipe_for_display for a non-empty recipe.
+    The templates mark the *_html parts safe, so every value from Tasty or the AI is escaped.
+    """
+
     if 'extendedIngredients' in recipe_data:
-        for ingredient in recipe_data['extendedIngredients']:
-            amount = ingredient.get('amount', '')
-            unit = ingredient.get('unit', '')
-            name = ingredient.get('originalName', '')
-            ingredients_html += f"<li>{amount} {unit} {name}</li>"
+        ingredients_html = "".join([
+            f"<li>{escape(ingredient.get('amount', ''))} {escape(ingredient.get('unit', ''))} {escape(ingredient.get('originalName', ''))}</li>"
+            for ingredient in recipe_data['extendedIngredients']
+        ])
     else:
-        ingredients_html += "<li>No ingredients listed.</li>"
-    ingredients_html += "</ul>"
+        ingredients_html = "<li>No ingredients listed.</li>"
 
-    instructions_html = "<ol>"
     if 'instructions' in recipe_data and recipe_data['instructions']:
         # Assuming instructions are line-separated steps from GenAI or Tasty
-        steps = recipe_data['instructions'].split('\n')
-        for step in steps:
-            if step.strip(): # Avoid empty list items
-                instructions_html += f"<li>{step.strip()}</li>"
+        # filter(None, ...) drops empty lines so they don't become empty list items
+        instructions_html = "".join([
+            f"<li>{escape(step)}</li>" for step in filter(None, map(str.strip, recipe_data['instructions'].splitlines()))
+        ])
     elif 'analyzedInstructions' in recipe_data and recipe_data['analyzedInstructions']:
-        for instruction_set in recipe_data['analyzedInstructions']:
-            for step in instruction_set.get('steps', []):
-                instructions_html += f"<li>Step {step.get('number')}: {step.get('step')}</li>"
+        instructions_html = "".join([
+            f"<li>Step {escape(step.get('number'))}: {escape(step.get('step'))}</li>"
+            for instruction_set in recipe_data['analyzedInstructions']
+            for step in instruction_set.get('steps', [])
+        ])
     else:
-        instructions_html += "<li>No instructions available.</li>"
-    instructions_html += "</ol>"
+        instructions_html = "<li>No instructions available.</li>"
 
-    nutrition_html = "<ul>"
     if 'nutrition' in recipe_data and 'nutrients' in recipe_data['nutrition']:
-        for nutrient in recipe_data['nutrition']['nutrients']:
-            if nutrient['name'] in ['Calories', 'Protein', 'Fat', 'Carbohydrates'] or nutrient['name'] == 'Summary':
-                nutrition_html += f"<li>{nutrient['name']}: {nutrient['amount']}{nutrient['unit']}</li>"
+        nutrition_html = "".join([
+            f"<li>{escape(nutrient['name'])}: {escape(nutrient['amount'])}{escape(nutrient['unit'])}</li>"
+            for nutrient in recipe_data['nutrition']['nutrients']
+            if nutrient['name'] in _SHOWN_NUTRIENTS
+        ])
     else:
-        nutrition_html += "<li>Nutritional information not available.</li>"
-    nutrition_html += "</ul>"
+        nutrition_html = "<li>Nutritional information not available.</li>"
 
     return {
         'title': recipe_data.get('title', 'N/A'),
@@ -47,8 +131,8 @@ def format_recipe_for_display(recipe_data):
         'readyInMinutes': recipe_data.get('readyInMinutes', 'N/A'),
         'sourceUrl': recipe_data.get('sourceUrl', 'N/A'),
         'image': recipe_data.get('image', None),
-        'ingredients_html': ingredients_html,
-        'instructions_html': instructions_html,
-        'nutrition_html': nutrition_html
+        'ingredients_html': f"<ul>{ingredients_html}</ul>",
+        'instructions_html': f"<ol>{instructions_html}</ol>",
+        'nutrition_html': f"<ul>{nutrition_html}</ul>"
     }
 
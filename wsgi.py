@@ -0,0 +1,7 @@
+# WSGI entry point for gunicorn: `gunicorn -c gunicorn.conf.py wsgi:app`.
+# Patch the standard library before anything imports socket/ssl so the sync
+# requests and openai calls yield to other greenlets instead of blocking the worker.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app